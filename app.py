@@ -1,13 +1,21 @@
 """
 Main Streamlit application for CineMetric
 """
+import sys
+import asyncio
 import streamlit as st
-import json
+import orjson
+from sqlalchemy.ext.asyncio import async_sessionmaker
 from database import (
-    init_db, get_db, get_all_personas, get_persona_by_id,
-    create_conversation, create_evaluation_result, import_personas_from_json
+    init_db, get_db, get_all_personas, get_persona_records,
+    hash_conversation, create_conversation, get_evaluation_results,
+    create_async_db_engine, acreate_evaluation_results,
+    import_personas_from_json
 )
-from groq_integration import evaluate_conversation
+
+# psycopg's async mode does not work on Windows' default ProactorEventLoop
+if sys.platform == "win32":
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 # Page configuration
 st.set_page_config(
@@ -16,6 +24,271 @@ st.set_page_config(
     layout="wide"
 )
 
+# Personas are read-only lookup data, so cache them across reruns
+@st.cache_data(ttl=3600)
+def load_personas():
+    """Load all personas as plain records (ORM objects don't survive caching)"""
+    db = get_db()
+    try:
+        return get_persona_records(db)
+    finally:
+        db.close()
+
+def add_token_usage(totals, usage):
+    """Accumulate one API call's token usage into a running totals dict"""
+    totals["requests"] = totals.get("requests", 0) + 1
+    for key, count in usage.items():
+        totals[key] = totals.get(key, 0) + count
+
+# Persona selection and evaluation run as fragments so their widgets don't rerun the whole app
+def get_selected_persona_ids(personas):
+    """Read the persona selection from the checkbox widget state"""
+    return [p.id for p in personas if st.session_state.get(f"persona_{p.id}")]
+
+@st.fragment
+def persona_selector(personas):
+    """Persona checkboxes and details; toggling one reruns only this fragment"""
+    personas_by_id = {p.id: p for p in personas}
+    
+    # Display personas with images
+    for persona in personas:
+        col_img, col_check = st.columns([1, 4])
+        
+        with col_img:
+            # Display persona image if available
+            if persona.image_url:
+                try:
+                    print(persona.image_url)
+                    st.image(persona.image_url, width=80)
+                except:
+                    st.write("🎭")  # Fallback emoji if image fails
+            else:
+                st.write("🎭")
+        
+        with col_check:
+            st.checkbox(
+                f"**{persona.name}**",
+                key=f"persona_{persona.id}",
+                help=persona.description
+            )
+    
+    # Show selected personas details
+    selected_persona_ids = get_selected_persona_ids(personas)
+    if selected_persona_ids:
+        st.markdown("---")
+        st.markdown("**Selected Characters:**")
+        for pid in selected_persona_ids:
+            persona = personas_by_id[pid]
+            with st.expander(f"📖 {persona.name}"):
+                if persona.image_url:
+                    st.image(persona.image_url, width=150)
+                st.write(persona.description)
+
+@st.fragment
+def evaluation_panel(personas, selected_metrics, conversation_text, is_multi_turn, turns, store_conversation):
+    """Evaluate button and results; clicking it reruns only this fragment"""
+    personas_by_id = {p.id: p for p in personas}
+    selected_persona_ids = get_selected_persona_ids(personas)
+    
+    # Persona checkboxes live in their own fragment, so the selection is checked on click
+    if st.button("🚀 Evaluate Conversation", type="primary", disabled=not (selected_metrics and conversation_text)):
+        if not selected_persona_ids:
+            st.error("❌ Please select at least one persona")
+        elif not selected_metrics:
+            st.error("❌ Please select at least one metric")
+        elif not conversation_text:
+            st.error("❌ Please enter a conversation")
+        else:
+            # Deferred so httpx/tenacity only load once an evaluation is requested
+            from groq_integration import aevaluate_many
+            
+            # Store conversation if requested
+            db = get_db() if store_conversation else None
+            saved_conversation = None
+            if store_conversation:
+                saved_conversation = create_conversation(
+                    db,
+                    content=conversation_text,
+                    is_multi_turn=is_multi_turn,
+                    turns=turns if is_multi_turn else None
+                )
+            
+            evaluated_personas = [personas_by_id[persona_id] for persona_id in selected_persona_ids]
+            
+            # Reuse results memoized this session, then those stored for this conversation
+            eval_cache = st.session_state.setdefault("eval_cache", {})
+            conversation_hash = hash_conversation(conversation_text)
+            known_results = {
+                (persona.id, metric): eval_cache[(persona.id, metric, conversation_hash)]
+                for persona in evaluated_personas
+                for metric in selected_metrics
+                if (persona.id, metric, conversation_hash) in eval_cache
+            }
+            stored_keys = set()
+            if saved_conversation:
+                for r in get_evaluation_results(db, saved_conversation.id):
+                    stored_keys.add((r.persona_id, r.metric))
+                    known_results.setdefault(
+                        (r.persona_id, r.metric),
+                        {"metric": r.metric, "score": r.score, "explanation": r.explanation}
+                    )
+            if db:
+                db.close()
+            pending_metrics = {
+                persona.id: [m for m in selected_metrics if (persona.id, m) not in known_results]
+                for persona in evaluated_personas
+            }
+            job_personas = [persona for persona in evaluated_personas if pending_metrics[persona.id]]
+            
+            # Results shown from the session memo but not yet stored for this conversation
+            carryover_results = []
+            if saved_conversation:
+                carryover_results = [
+                    {"persona_id": persona_id, **result}
+                    for (persona_id, metric), result in known_results.items()
+                    if (persona_id, metric) not in stored_keys
+                ]
+            
+            # Live progress: one line per persona, showing its response while it streams
+            if job_personas:
+                status = st.status(f"Evaluating with {len(job_personas)} persona(s)...", expanded=True)
+                drafts = []
+                with status:
+                    for persona in job_personas:
+                        draft = st.empty()
+                        draft.caption(f"⏳ {persona.name}")
+                        drafts.append(draft)
+            
+            # One container per persona for the results
+            containers = []
+            for persona in evaluated_personas:
+                container = st.container()
+                with container:
+                    st.markdown(f"---")
+                    st.subheader(f"🎭 {persona.name}")
+                containers.append(container)
+            
+            # Token usage for this batch and, in session_state, for the whole session
+            batch_usage = {}
+            
+            def record_usage(usage):
+                add_token_usage(batch_usage, usage)
+                add_token_usage(st.session_state.setdefault("token_usage", {}), usage)
+            
+            # Dispatch one evaluation per persona (all metrics in one call), concurrently
+            jobs = []
+            if job_personas:
+                jobs = [
+                    {
+                        "prompt_template": persona.prompt_template,
+                        "metrics": pending_metrics[persona.id],
+                        "conversation": conversation_text,
+                        "persona_context": f"{persona.name}: {persona.description}",
+                        "on_delta": lambda text, draft=draft: draft.code(text, language="json"),
+                        "on_usage": record_usage
+                    }
+                    for persona, draft in zip(job_personas, drafts)
+                ]
+                completed = []
+                
+                def report_progress(index, outcome):
+                    """Collapse a finished persona's draft into a one-line summary"""
+                    persona = job_personas[index]
+                    completed.append(index)
+                    if isinstance(outcome, Exception):
+                        drafts[index].markdown(f"❌ **{persona.name}** failed")
+                    else:
+                        drafts[index].markdown(f"✅ **{persona.name}**: {', '.join(pending_metrics[persona.id])}")
+                    status.update(label=f"Evaluated {len(completed)}/{len(jobs)} persona(s)...")
+            
+            # Persist results on the async engine while the remaining API calls run
+            write_errors = []
+            
+            async def store_results(session_factory, results):
+                """Save results for the stored conversation, recording any failure"""
+                try:
+                    async with session_factory() as adb:
+                        await acreate_evaluation_results(adb, saved_conversation.id, results)
+                except Exception as e:
+                    write_errors.append(e)
+            
+            async def evaluate_and_store():
+                """Run the Groq batch, saving each persona's results as soon as they arrive"""
+                # Engine local to this event loop, so its pooled connections never outlive it
+                async_engine = create_async_db_engine() if saved_conversation else None
+                session_factory = async_sessionmaker(async_engine, expire_on_commit=False)
+                try:
+                    writes = [asyncio.create_task(store_results(session_factory, carryover_results))] if carryover_results else []
+                    
+                    def on_complete(index, outcome):
+                        report_progress(index, outcome)
+                        if saved_conversation and not isinstance(outcome, Exception):
+                            rows = [
+                                {"persona_id": job_personas[index].id, **evaluation}
+                                for evaluation in outcome
+                                if "error" not in evaluation
+                            ]
+                            if rows:
+                                writes.append(asyncio.create_task(store_results(session_factory, rows)))
+                    
+                    results = await aevaluate_many(jobs, on_complete=on_complete) if jobs else []
+                    await asyncio.gather(*writes)
+                    return results
+                finally:
+                    if async_engine is not None:
+                        await async_engine.dispose()
+            
+            fresh_results = {}
+            if jobs or carryover_results:
+                results = asyncio.run(evaluate_and_store())
+                fresh_results = {persona.id: outcome for persona, outcome in zip(job_personas, results)}
+            if jobs:
+                failed = any(isinstance(outcome, Exception) for outcome in results)
+                status.update(
+                    label="Evaluation finished with errors" if failed else "Evaluation complete",
+                    state="error" if failed else "complete",
+                    expanded=False
+                )
+            if batch_usage:
+                st.caption(
+                    f"🔢 {batch_usage['prompt_tokens']} prompt tokens "
+                    f"({batch_usage['cached_tokens']} served from prompt cache), "
+                    f"{batch_usage['completion_tokens']} completion tokens"
+                )
+            
+            if write_errors:
+                st.error(f"❌ Saving results failed: {str(write_errors[0])}")
+            
+            # Render results, in selection order
+            for persona, container in zip(evaluated_personas, containers):
+                with container:
+                    persona_results = fresh_results.get(persona.id, [])
+                    if isinstance(persona_results, Exception):
+                        st.error(f"❌ Evaluation failed: {str(persona_results)}")
+                        persona_results = []
+                    new_by_metric = {r["metric"]: r for r in persona_results}
+                    
+                    for metric in selected_metrics:
+                        result = new_by_metric.get(metric) or known_results.get((persona.id, metric))
+                        if result is None:
+                            continue
+                        if "error" in result:
+                            st.error(f"❌ {metric}: {result['error']}")
+                            continue
+                        eval_cache[(persona.id, metric, conversation_hash)] = result
+                        
+                        # Display results
+                        st.markdown(f"**📈 {metric}**")
+                        
+                        # Score visualization
+                        score = result["score"]
+                        st.progress(score / 10)
+                        st.metric(label="Score", value=f"{score}/10")
+                        
+                        # Explanation
+                        st.markdown("**💭 Evaluation:**")
+                        st.info(result["explanation"])
+
 # Initialize database
 @st.cache_resource
 def initialize_database():
@@ -29,9 +302,10 @@ def initialize_database():
         st.info("📥 Importing default personas...")
         # Load personas from JSON file
         try:
-            with open("personas.json", "r") as f:
-                personas_data = json.load(f)
+            with open("personas.json", "rb") as f:
+                personas_data = orjson.loads(f.read())
             import_personas_from_json(db, personas_data["personas"])
+            load_personas.clear()
         except FileNotFoundError:
             st.warning("⚠️ personas.json file not found. Please create it manually.")
     
@@ -51,47 +325,13 @@ col1, col2 = st.columns([1, 1])
 with col1:
     st.subheader("🎭 Select Personas")
     
-    # Get personas from database
-    db = get_db()
-    personas = get_all_personas(db)
+    # Get personas (cached)
+    personas = load_personas()
     
     if len(personas) == 0:
         st.error("❌ No personas found in database. Please import personas first.")
     else:
-        # Display personas with images
-        selected_persona_ids = []
-        for persona in personas:
-            col_img, col_check = st.columns([1, 4])
-            
-            with col_img:
-                # Display persona image if available
-                if persona.image_url:
-                    try:
-                        print(persona.image_url)
-                        st.image(persona.image_url, width=80)
-                    except:
-                        st.write("🎭")  # Fallback emoji if image fails
-                else:
-                    st.write("🎭")
-            
-            with col_check:
-                if st.checkbox(
-                    f"**{persona.name}**",
-                    key=f"persona_{persona.id}",
-                    help=persona.description
-                ):
-                    selected_persona_ids.append(persona.id)
-        
-        # Show selected personas details
-        if selected_persona_ids:
-            st.markdown("---")
-            st.markdown("**Selected Characters:**")
-            for pid in selected_persona_ids:
-                persona = get_persona_by_id(db, pid)
-                with st.expander(f"📖 {persona.name}"):
-                    if persona.image_url:
-                        st.image(persona.image_url, width=150)
-                    st.write(persona.description)
+        persona_selector(personas)
 
 with col2:
     st.subheader("📊 Evaluation Metrics")
@@ -157,73 +397,8 @@ evaluate_per_turn = st.checkbox(
 
 store_conversation = st.checkbox("Save conversation to database", value=True)
 
-# Evaluate button
-if st.button("🚀 Evaluate Conversation", type="primary", disabled=not (selected_persona_ids and selected_metrics and conversation_text)):
-    if not selected_persona_ids:
-        st.error("❌ Please select at least one persona")
-    elif not selected_metrics:
-        st.error("❌ Please select at least one metric")
-    elif not conversation_text:
-        st.error("❌ Please enter a conversation")
-    else:
-        # Store conversation if requested
-        saved_conversation = None
-        if store_conversation:
-            saved_conversation = create_conversation(
-                db,
-                content=conversation_text,
-                is_multi_turn=is_multi_turn,
-                turns=turns if is_multi_turn else None
-            )
-        
-        # Evaluate with each persona
-        for persona_id in selected_persona_ids:
-            persona = get_persona_by_id(db, persona_id)
-            
-            st.markdown(f"---")
-            st.subheader(f"🎭 {persona.name}")
-            
-            persona_context = f"{persona.name}: {persona.description}"
-            
-            # Evaluate each metric
-            for metric in selected_metrics:
-                with st.spinner(f"Evaluating {metric.lower()}..."):
-                    try:
-                        result = evaluate_conversation(
-                            prompt_template=persona.prompt_template,
-                            metric=metric,
-                            conversation=conversation_text,
-                            persona_context=persona_context
-                        )
-                        
-                        # Display results
-                        st.markdown(f"**📈 {metric}**")
-                        
-                        # Score visualization
-                        score = result["score"]
-                        st.progress(score / 10)
-                        st.metric(label="Score", value=f"{score}/10")
-                        
-                        # Explanation
-                        st.markdown("**💭 Evaluation:**")
-                        st.info(result["explanation"])
-                        
-                        # Save to database if conversation was stored
-                        if saved_conversation:
-                            create_evaluation_result(
-                                db,
-                                conversation_id=saved_conversation.id,
-                                persona_id=persona.id,
-                                metric=metric,
-                                score=score,
-                                explanation=result["explanation"]
-                            )
-                        
-                    except Exception as e:
-                        st.error(f"❌ Evaluation failed: {str(e)}")
-
-# Close database connection
-db.close()
+# Evaluate button and results
+evaluation_panel(personas, selected_metrics, conversation_text, is_multi_turn, turns, store_conversation)
 
 # Sidebar
 with st.sidebar:
@@ -246,8 +421,15 @@ with st.sidebar:
     
     st.markdown("---")
     st.markdown("**Available Personas:**")
-    db = get_db()
-    personas = get_all_personas(db)
     for p in personas:
         st.markdown(f"• {p.name}")
-    db.close()
\ No newline at end of file
+    
+    # Cumulative Groq token usage (refreshed on the next full rerun)
+    token_usage = st.session_state.get("token_usage")
+    if token_usage:
+        st.markdown("---")
+        st.markdown("**Token Usage (this session):**")
+        st.markdown(f"• API calls: {token_usage['requests']}")
+        st.markdown(f"• Prompt tokens: {token_usage['prompt_tokens']}")
+        st.markdown(f"• Cached prompt tokens: {token_usage['cached_tokens']}")
+        st.markdown(f"• Completion tokens: {token_usage['completion_tokens']}")
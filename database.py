@@ -2,9 +2,16 @@
 Database models and connection setup using SQLAlchemy
 """
 import os
-from sqlalchemy import create_engine, Column, Integer, String, Text, Boolean, DateTime, JSON, ForeignKey
+import hashlib
+from collections import namedtuple
+import orjson
+from sqlalchemy import create_engine, text, Column, Integer, String, Text, Boolean, DateTime, JSON, ForeignKey, UniqueConstraint
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, load_only
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -16,12 +23,44 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is not set")
 
-# Create engine
-engine = create_engine(DATABASE_URL)
+# psycopg (v3) serves both the sync and the async engine
+DATABASE_URL = make_url(DATABASE_URL)
+if DATABASE_URL.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+    DATABASE_URL = DATABASE_URL.set(drivername="postgresql+psycopg")
+
+# JSON columns (turns, turn_evaluations) go through orjson
+JSON_OPTIONS = {
+    "json_serializer": lambda obj: orjson.dumps(obj).decode(),
+    "json_deserializer": orjson.loads
+}
+
+# Create engine with a connection pool that outlives Streamlit reruns
+engine = create_engine(
+    DATABASE_URL,
+    pool_size=5,
+    max_overflow=10,
+    pool_pre_ping=True,
+    pool_recycle=1800,
+    **JSON_OPTIONS
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def create_async_db_engine():
+    """Create an async engine for writes that overlap with API calls.
+
+    Async connections are bound to the event loop that opened them, so create
+    one engine per asyncio.run() and dispose of it before the loop closes.
+    """
+    return create_async_engine(DATABASE_URL, pool_size=5, max_overflow=10, **JSON_OPTIONS)
+
 Base = declarative_base()
 
 
+# Plain, session-independent view of a persona for read-only use
+PersonaRecord = namedtuple("PersonaRecord", "id name description prompt_template image_url")
+
+
 # Models
 class Persona(Base):
     """Movie character personas for evaluation"""
@@ -44,6 +83,7 @@ class Conversation(Base):
     
     id = Column(Integer, primary_key=True, index=True)
     content = Column(Text, nullable=False)
+    conversation_hash = Column(String(64), unique=True, index=True)
     is_multi_turn = Column(Boolean, default=False, nullable=False)
     turns = Column(JSON, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -55,6 +95,9 @@ class Conversation(Base):
 class EvaluationResult(Base):
     """Evaluation results from personas"""
     __tablename__ = "evaluation_results"
+    __table_args__ = (
+        UniqueConstraint("conversation_id", "persona_id", "metric", name="uq_evaluation_result"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     conversation_id = Column(Integer, ForeignKey("conversations.id"), nullable=False)
@@ -70,10 +113,22 @@ class EvaluationResult(Base):
     persona = relationship("Persona", back_populates="evaluation_results")
 
 
+# Schema changes create_all can't apply to tables that already exist
+SCHEMA_UPGRADES = [
+    "ALTER TABLE conversations ADD COLUMN IF NOT EXISTS conversation_hash VARCHAR(64)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_conversations_conversation_hash ON conversations (conversation_hash)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_evaluation_result ON evaluation_results (conversation_id, persona_id, metric)",
+]
+
+
 # Database initialization
 def init_db():
-    """Create all tables"""
+    """Create all tables and bring existing ones up to date"""
     Base.metadata.create_all(bind=engine)
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            for statement in SCHEMA_UPGRADES:
+                conn.execute(text(statement))
     print("✅ Database tables created successfully")
 
 
@@ -92,38 +147,74 @@ def get_all_personas(db):
     return db.query(Persona).all()
 
 
-def get_persona_by_id(db, persona_id):
-    """Get a specific persona by ID"""
-    return db.query(Persona).filter(Persona.id == persona_id).first()
+def get_persona_records(db):
+    """Get all personas as PersonaRecord tuples, loading only the columns they need"""
+    rows = db.query(Persona).options(
+        load_only(Persona.id, Persona.name, Persona.description, Persona.prompt_template, Persona.image_url)
+    ).all()
+    return [PersonaRecord(p.id, p.name, p.description, p.prompt_template, p.image_url) for p in rows]
+
+
+def hash_conversation(content, is_multi_turn=False, turns=None):
+    """SHA-256 hex digest identifying a conversation's content and, if multi-turn, its turns"""
+    raw = content
+    if is_multi_turn:
+        raw += "\0" + orjson.dumps(turns).decode()
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
 
 def create_conversation(db, content, is_multi_turn=False, turns=None):
-    """Create a new conversation"""
+    """Create a new conversation, or return the stored one with identical content and turns"""
+    conversation_hash = hash_conversation(content, is_multi_turn, turns)
+    existing = db.query(Conversation).filter_by(conversation_hash=conversation_hash).first()
+    if existing:
+        return existing
+    
     conversation = Conversation(
         content=content,
+        conversation_hash=conversation_hash,
         is_multi_turn=is_multi_turn,
         turns=turns
     )
     db.add(conversation)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another session stored the same content between our check and insert
+        db.rollback()
+        return db.query(Conversation).filter_by(conversation_hash=conversation_hash).one()
     db.refresh(conversation)
     return conversation
 
 
-def create_evaluation_result(db, conversation_id, persona_id, metric, score, explanation, turn_evaluations=None):
-    """Create a new evaluation result"""
-    result = EvaluationResult(
-        conversation_id=conversation_id,
-        persona_id=persona_id,
-        metric=metric,
-        score=score,
-        explanation=explanation,
-        turn_evaluations=turn_evaluations
-    )
-    db.add(result)
-    db.commit()
-    db.refresh(result)
-    return result
+def get_evaluation_results(db, conversation_id):
+    """Get all stored evaluation results for a conversation"""
+    return db.query(EvaluationResult).filter(EvaluationResult.conversation_id == conversation_id).all()
+
+
+async def acreate_evaluation_results(db, conversation_id, results):
+    """Create several evaluation results in a single transaction on an AsyncSession.
+
+    Rows another session already stored for the same conversation, persona and
+    metric are skipped. Returns the number of rows inserted.
+    """
+    stmt = pg_insert(EvaluationResult).values([
+        {
+            "conversation_id": conversation_id,
+            "persona_id": result["persona_id"],
+            "metric": result["metric"],
+            "score": result["score"],
+            "explanation": result["explanation"],
+            "turn_evaluations": result.get("turn_evaluations")
+        }
+        for result in results
+    ])
+    # Target the columns rather than the constraint name: on upgraded databases
+    # uq_evaluation_result is a unique index, not a table constraint
+    stmt = stmt.on_conflict_do_nothing(index_elements=["conversation_id", "persona_id", "metric"])
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount
 
 
 def import_personas_from_json(db, personas_data):
@@ -2,10 +2,16 @@
 Groq API integration for LLM-based conversation evaluation
 """
 import os
-import requests
-import json
+import asyncio
+import hashlib
+import tempfile
+import time
+from functools import lru_cache
 import re
+import httpx
+import orjson
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # Load environment variables
 load_dotenv()
@@ -13,101 +19,387 @@ load_dotenv()
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 MODEL_ID = "llama-3.1-8b-instant"
 GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+CACHE_DIR = os.getenv("CINEMETRIC_CACHE_DIR", os.path.join(".cache", "evaluations"))
 
+# Minimum spacing between on_delta updates while streaming
+STREAM_UPDATE_INTERVAL = 0.1
+STREAM_UPDATE_CHARS = 200
 
-def evaluate_conversation(
+# Retry policy for transient API failures (rate limits, 5xx, network errors)
+MAX_ATTEMPTS = 5
+MAX_RATE_LIMIT_WAIT = 60
+_backoff = wait_exponential_jitter(initial=1, max=30)
+_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|h|m|s)')
+
+# {{METRIC}} / {{CONVERSATION}} placeholders in persona prompt templates
+_PLACEHOLDER_RE = re.compile(r'\{\{(METRIC|CONVERSATION)\}\}')
+
+# Characters ignored when matching returned metric names to requested ones
+_METRIC_NAME_RE = re.compile(r'[^0-9a-z]')
+
+# Outermost JSON object in a model response (streamed responses aren't in JSON mode)
+_JSON_RE = re.compile(r'\{[\s\S]*\}')
+
+# System prompt for structured output, shared by every request
+SYSTEM_PROMPT = (
+    "You are an expert conversation evaluator with a deep understanding of human interactions and communication patterns. "
+    "You will be taking on the persona specified in the prompt to evaluate conversations based on one or more metrics. "
+    "Analyze the conversation through the lens of this persona and each requested metric independently. "
+    'IMPORTANT: Respond with ONLY a valid JSON object in this exact format: '
+    '{ "evaluations": [ { "metric": string, "score": number, "explanation": string } ] }, '
+    "with exactly one entry per requested metric, using the metric name exactly as given. "
+    "Each score must be a number from 0 to 10, where 0 is extremely low and 10 is extremely high for that metric. "
+    "Each explanation should be detailed and provide specific examples from the conversation that justify your scoring. "
+    "Stay true to the persona's unique perspective throughout your evaluation. "
+    "Do not include any additional text, preamble, or commentary before or after the JSON object."
+)
+
+
+def _normalize_metric(name) -> str:
+    """Metric name for matching, ignoring case, spacing and punctuation"""
+    return _METRIC_NAME_RE.sub("", str(name).lower())
+
+
+def _parse_evaluation(item: dict) -> dict:
+    """Validate one {score, explanation} entry, normalizing the score to 0-10"""
+    if not isinstance(item, dict) or "score" not in item or "explanation" not in item:
+        raise ValueError("missing score or explanation")
+    
+    explanation = item["explanation"]
+    if not isinstance(explanation, str) or not explanation.strip():
+        raise ValueError("explanation is empty or not text")
+    
+    try:
+        if isinstance(item["score"], bool):
+            raise TypeError
+        score = max(0, min(10, int(float(item["score"]))))
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f"score is not a number: {item['score']!r}")
+    
+    return {"score": score, "explanation": explanation}
+
+
+@lru_cache(maxsize=64)
+def _split_template(prompt_template: str) -> tuple:
+    """Split a template into alternating literal text and placeholder names"""
+    return tuple(_PLACEHOLDER_RE.split(prompt_template))
+
+
+def _fill_template(prompt_template: str, values: dict) -> list:
+    """Template pieces with placeholders substituted, ready for a single join"""
+    return [
+        values[part] if i % 2 else part
+        for i, part in enumerate(_split_template(prompt_template))
+    ]
+
+
+def _build_client() -> httpx.AsyncClient:
+    """Create an HTTP/2 keep-alive client carrying the Groq auth headers"""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=30,
+        limits=httpx.Limits(max_keepalive_connections=5, keepalive_expiry=60),
+        headers={
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {GROQ_API_KEY}"
+        }
+    )
+
+
+def _cache_key(prompt_template, metric, conversation, persona_context, previous_turn_context) -> str:
+    """Deterministic SHA-256 key for an evaluation request"""
+    raw = "|".join([
+        MODEL_ID,
+        prompt_template,
+        metric,
+        conversation,
+        persona_context or "",
+        previous_turn_context or ""
+    ])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _read_cache(key: str):
+    """Return the cached evaluation for key, or None on a miss"""
+    try:
+        with open(os.path.join(CACHE_DIR, f"{key}.json"), "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def _write_cache(key: str, result: dict):
+    """Atomically store an evaluation so readers never see a partial file"""
+    tmp_path = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(result))
+        os.replace(tmp_path, os.path.join(CACHE_DIR, f"{key}.json"))
+    except OSError as e:
+        print(f"⚠️ Could not write evaluation cache: {e}")
+        if tmp_path:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+
+def _parse_duration(value: str) -> float:
+    """Parse a Groq reset header such as "2m59.56s" or "250ms" into seconds"""
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in _DURATION_RE.findall(value))
+
+
+def _rate_limit_delay(headers) -> float:
+    """Seconds Groq asks us to wait before retrying a 429, or 0 if unknown"""
+    try:
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+        if "x-ratelimit-reset-tokens" in headers:
+            return _parse_duration(headers["x-ratelimit-reset-tokens"])
+    except ValueError:
+        pass
+    return 0
+
+
+def _is_transient(exc: BaseException) -> bool:
+    """Whether a failed request is worth retrying"""
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code == 429 or exc.response.status_code >= 500
+    return isinstance(exc, httpx.TransportError)
+
+
+def _wait_before_retry(retry_state) -> float:
+    """Exponential backoff with jitter, but never sooner than a 429's reset time"""
+    delay = _backoff(retry_state)
+    exc = retry_state.outcome.exception()
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429:
+        delay = max(delay, min(_rate_limit_delay(exc.response.headers), MAX_RATE_LIMIT_WAIT))
+    return delay
+
+
+def _summarize_usage(usage: dict) -> dict:
+    """Reduce an API usage block to prompt, cached-prompt and completion token counts"""
+    return {
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "cached_tokens": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0)
+    }
+
+
+@retry(
+    retry=retry_if_exception(_is_transient),
+    wait=_wait_before_retry,
+    stop=stop_after_attempt(MAX_ATTEMPTS),
+    reraise=True
+)
+async def _stream_completion(client: httpx.AsyncClient, payload: dict, on_delta=None, on_usage=None) -> str:
+    """
+    Stream a chat completion over SSE, reporting the accumulated text to on_delta
+    
+    on_delta is throttled to every STREAM_UPDATE_INTERVAL seconds or
+    STREAM_UPDATE_CHARS characters, plus a final call with the full text.
+    Token usage from the final chunk (including prefix-cache hits) goes to on_usage.
+    Transient failures are retried with backoff; a retry restarts the stream.
+    """
+    text = ""
+    reported_len = 0
+    reported_at = time.monotonic()
+    # The client already sends Content-Type: application/json
+    async with client.stream("POST", GROQ_API_URL, content=orjson.dumps(payload)) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            chunk = line[len("data:"):].strip()
+            if chunk == "[DONE]":
+                break
+            
+            data = orjson.loads(chunk)
+            choices = data.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                text += delta
+                now = time.monotonic()
+                if on_delta and (
+                    now - reported_at >= STREAM_UPDATE_INTERVAL
+                    or len(text) - reported_len >= STREAM_UPDATE_CHARS
+                ):
+                    on_delta(text)
+                    reported_len, reported_at = len(text), now
+            
+            # Groq reports usage on the last chunk under x_groq; OpenAI-style under usage
+            usage = data.get("usage") or data.get("x_groq", {}).get("usage")
+            if usage and on_usage:
+                on_usage(_summarize_usage(usage))
+    
+    if on_delta and len(text) > reported_len:
+        on_delta(text)
+    return text
+
+
+async def aevaluate_conversation(
+    client: httpx.AsyncClient,
     prompt_template: str,
-    metric: str,
+    metrics: list,
     conversation: str,
     persona_context: str = None,
-    previous_turn_context: str = None
-) -> dict:
+    previous_turn_context: str = None,
+    on_delta=None,
+    on_usage=None
+) -> list:
     """
-    Evaluate a conversation using the Groq API
+    Evaluate a conversation on several metrics with a single Groq API call
+    
+    Results are cached on disk per metric under CACHE_DIR; only metrics
+    without a cached result are sent to the API.
     
     Args:
+        client: Shared async HTTP client (see _build_client) used for the request
         prompt_template: The persona's prompt template with {{METRIC}} and {{CONVERSATION}} placeholders
-        metric: The evaluation metric (e.g., "empathy", "clarity")
+        metrics: The evaluation metrics (e.g., ["empathy", "clarity"])
         conversation: The conversation text to evaluate
         persona_context: Optional additional context about the persona
         previous_turn_context: Optional context from previous turns
+        on_delta: Optional callback receiving the response text streamed so far
+        on_usage: Optional callback receiving the call's token usage counts
         
     Returns:
-        dict: {"score": int (0-10), "explanation": str}
+        list: [{"metric": str, "score": int (0-10), "explanation": str}], in the order of metrics;
+            a metric the response didn't cover yields {"metric": str, "error": str} instead
     """
     if not GROQ_API_KEY:
         raise ValueError("GROQ_API_KEY environment variable is not set")
     
-    # Build the enhanced prompt
-    enhanced_prompt = prompt_template
+    # Serve repeat evaluations from the disk cache
+    cache_keys = {
+        metric: _cache_key(prompt_template, metric, conversation, persona_context, previous_turn_context)
+        for metric in metrics
+    }
+    evaluations = {}
+    for metric, key in cache_keys.items():
+        cached = _read_cache(key)
+        if cached is not None:
+            try:
+                evaluations[metric] = {"metric": metric, **_parse_evaluation(cached)}
+            except ValueError:
+                pass  # Unusable cache entry; evaluate again and overwrite it
+    
+    missing_metrics = [metric for metric in metrics if metric not in evaluations]
+    if not missing_metrics:
+        return [evaluations[metric] for metric in metrics]
+    
+    # Build the enhanced prompt, substituting placeholders in one pass. The
+    # persona profile goes first so the system prompt + persona prefix is
+    # identical across calls and can be served from Groq's prompt cache.
+    metric_list = ", ".join(missing_metrics)
+    prompt_parts = []
     
     if persona_context:
-        enhanced_prompt += f"\n\nPersona Profile: {persona_context}"
+        prompt_parts.append(f"Persona Profile: {persona_context}\n\n")
+    
+    prompt_parts.extend(_fill_template(prompt_template, {"METRIC": metric_list, "CONVERSATION": conversation}))
     
     if previous_turn_context:
-        enhanced_prompt += f"\n\nPrevious Context: {previous_turn_context}"
-    
-    # Replace placeholders
-    filled_prompt = enhanced_prompt.replace("{{METRIC}}", metric).replace("{{CONVERSATION}}", conversation)
-    
-    # System prompt for structured output
-    system_prompt = (
-        "You are an expert conversation evaluator with a deep understanding of human interactions and communication patterns. "
-        "You will be taking on the persona specified in the prompt to evaluate conversations based on specific metrics. "
-        "Analyze the conversation through the lens of this persona and the requested metric. "
-        'IMPORTANT: Respond with ONLY a valid JSON object in this exact format: { "score": number, "explanation": string }. '
-        "The score must be a number from 0 to 10, where 0 is extremely low and 10 is extremely high for the metric. "
-        "The explanation should be detailed and provide specific examples from the conversation that justify your scoring. "
-        "Stay true to the persona's unique perspective throughout your evaluation. "
-        "Do not include any additional text, preamble, or commentary before or after the JSON object."
-    )
+        prompt_parts.append(f"\n\nPrevious Context: {previous_turn_context}")
     
-    # Prepare API request
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {GROQ_API_KEY}"
-    }
+    filled_prompt = "".join(prompt_parts)
     
+    # Prepare API request
     payload = {
         "model": MODEL_ID,
         "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": filled_prompt}
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"{filled_prompt}\n\nMetrics to evaluate: {metric_list}"}
         ],
-        "max_tokens": 1024,
+        "max_tokens": min(1024 * len(missing_metrics), 8192),
         "temperature": 0.1,
-        "response_format": {"type": "json_object"}
+        # Groq's JSON mode can't be combined with streaming; the system prompt
+        # and the extraction below keep the output a single JSON object
+        "stream": True
     }
     
     # Make API call
     try:
-        response = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        
-        # Parse response
-        data = response.json()
-        response_text = data["choices"][0]["message"]["content"].strip()
+        response_text = (await _stream_completion(client, payload, on_delta, on_usage)).strip()
         
         # Extract JSON from response
-        json_match = re.search(r'\{[\s\S]*\}', response_text)
+        json_match = _JSON_RE.search(response_text)
         if not json_match:
             raise ValueError("No JSON object found in response")
         
-        result = json.loads(json_match.group(0))
+        result = orjson.loads(json_match.group(0))
         
-        # Validate result
-        if "score" not in result or "explanation" not in result:
-            raise ValueError("Response missing required fields")
+        # Persona templates ask for "a score ... and a detailed explanation", so a
+        # single-metric reply may come back as a bare {score, explanation} object
+        if "evaluations" not in result and len(missing_metrics) == 1 and "score" in result:
+            result = {"evaluations": [{**result, "metric": missing_metrics[0]}]}
         
-        # Normalize score to 0-10 range
-        score = max(0, min(10, int(result["score"])))
+        # Match returned evaluations back to the requested metrics by name
+        items = [item for item in result["evaluations"] if isinstance(item, dict)]
+        returned = {_normalize_metric(item.get("metric", "")): item for item in items}
+        matched = {metric: returned.get(_normalize_metric(metric)) for metric in missing_metrics}
         
-        return {
-            "score": score,
-            "explanation": result["explanation"]
-        }
+        # Names echoed differently: fall back to response order for the unmatched ones
+        if len(items) == len(missing_metrics):
+            used = [id(item) for item in matched.values() if item is not None]
+            for position, metric in enumerate(missing_metrics):
+                if matched[metric] is None and id(items[position]) not in used:
+                    matched[metric] = items[position]
+        
+        for metric in missing_metrics:
+            item = matched[metric]
+            
+            # Validate result; a bad entry only fails its own metric
+            try:
+                if item is None:
+                    raise ValueError("missing from response")
+                evaluation = _parse_evaluation(item)
+            except ValueError as e:
+                evaluations[metric] = {"metric": metric, "error": f"Failed to parse evaluation: {str(e)}"}
+                continue
+            
+            _write_cache(cache_keys[metric], evaluation)
+            evaluations[metric] = {"metric": metric, **evaluation}
         
-    except requests.exceptions.RequestException as e:
+        return [evaluations[metric] for metric in metrics]
+        
+    except httpx.HTTPError as e:
         raise Exception(f"Groq API request failed: {str(e)}")
-    except (json.JSONDecodeError, KeyError, ValueError) as e:
-        raise Exception(f"Failed to parse Groq API response: {str(e)}")
\ No newline at end of file
+    except (orjson.JSONDecodeError, KeyError, TypeError, ValueError) as e:
+        raise Exception(f"Failed to parse Groq API response: {str(e)}")
+
+
+async def _indexed(index: int, coro):
+    """Await coro, tagging its result (or exception) with the job index"""
+    try:
+        return index, await coro
+    except Exception as e:
+        return index, e
+
+
+async def aevaluate_many(jobs: list, on_complete=None) -> list:
+    """
+    Evaluate several conversations concurrently over one shared client
+    
+    All requests in the batch are multiplexed over the same HTTP/2 connection,
+    so only the first one pays for the TCP/TLS handshake.
+    
+    Args:
+        jobs: List of keyword-argument dicts for aevaluate_conversation
+        on_complete: Optional callback(index, outcome) invoked as each job finishes
+        
+    Returns:
+        list: One evaluation list per job, in order; failed jobs yield the raised exception
+    """
+    results = [None] * len(jobs)
+    async with _build_client() as client:
+        tasks = [_indexed(i, aevaluate_conversation(client, **job)) for i, job in enumerate(jobs)]
+        for next_done in asyncio.as_completed(tasks):
+            index, outcome = await next_done
+            results[index] = outcome
+            if on_complete:
+                on_complete(index, outcome)
+    return results